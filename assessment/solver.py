@@ -1,24 +1,87 @@
+import random
 import time
-import requests
-from bs4 import BeautifulSoup
-import json
-
-from assessment.types import QUESTION_TYPE_MAP, MODEL_MAP, deep_blank_model, WHITELISTED_QUESTION_TYPES
+import httpx
+import orjson
+from functools import lru_cache
+from typing import Optional
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:  # Fall back to BeautifulSoup if selectolax is not installed
+    LexborHTMLParser = None
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    # Coursera's CML wraps prompt text in <text> blocks, so it is kept alongside the HTML text tags.
+    TEXT_STRAINER = SoupStrainer(['text', 'p', 'span', 'div', 'li', 'strong', 'em', 'b', 'i', 'code', 'pre', 'br',
+                                  'td', 'th', 'math', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'a'])
+
+from assessment.types import (QUESTION_TYPE_MAP, ANSWER_KEY_MAP, MODEL_MAP, deep_blank_model,
+                              WHITELISTED_QUESTION_TYPES)
 from config import GRAPHQL_URL
 from assessment.queries import (GET_STATE_QUERY, SAVE_RESPONSES_QUERY, SUBMIT_DRAFT_QUERY,
                                 GRADING_STATUS_QUERY, INITIATE_ATTEMPT_QUERY)
 from loguru import logger
-from llm.connector import GeminiConnector
+from llm.connector import GeminiConnector, GeminiStreamError
+
+# Number of streamed LLM answers to collect before saving them in single-page mode.
+STREAMED_SAVE_BATCH_SIZE = 5
+
+
+@lru_cache(maxsize=4096)
+def _cml_to_text(html: str) -> str:
+    """
+    Extracts the plain text from a question prompt or option's CML/HTML.
+    Cached, since the same parts are revisited on every pass over the draft.
+    """
+    if not html:
+        return ''
+    if LexborHTMLParser is not None:
+        text = LexborHTMLParser(html).text(separator=' ')
+    else:
+        text = BeautifulSoup(html, 'lxml', parse_only=TEXT_STRAINER).get_text(separator=' ')
+        if not text.strip():
+            # Nothing matched the strainer (e.g. a bare-text cmlValue); parse everything rather than send an
+            # empty prompt. Bare text mixed in with strained tags is still dropped on this fallback path.
+            text = BeautifulSoup(html, 'lxml').get_text(separator=' ')
+    # Collapse runs of whitespace so the prompt sent to the LLM carries no wasted tokens
+    return ' '.join(text.split())
 
 
 class GradedSolver(object):
-    def __init__(self, session: requests.Session, course_id: str, item_id: str):
-        self.session: requests.Session = session
+    def __init__(self, session: httpx.Client, course_id: str, item_id: str):
+        self.session: httpx.Client = session
         self.course_id: str = course_id
         self.item_id: str = item_id
         self.attempt_id = None
         self.draft_id = None
         self.question_type_cache = {}
+        self.prompt_cache: dict[str, dict] = {}
+
+        # GraphQL bodies are built once; calls only fill in the attempt-specific fields.
+        self._state_body = {
+            "operationName": "QueryState",
+            "variables": {"courseId": course_id, "itemId": item_id},
+            "query": GET_STATE_QUERY
+        }
+        self._initiate_body = {
+            "operationName": "Submission_StartAttempt",
+            "variables": {"courseId": course_id, "itemId": item_id},
+            "query": INITIATE_ATTEMPT_QUERY
+        }
+        self._save_body = {
+            "operationName": "Submission_SaveResponses",
+            "variables": {
+                "input": {"courseId": course_id, "itemId": item_id, "attemptId": None, "questionResponses": None}
+            },
+            "query": SAVE_RESPONSES_QUERY
+        }
+        self._submit_body = {
+            "operationName": "Submission_SubmitLatestDraft",
+            "query": SUBMIT_DRAFT_QUERY,
+            "variables": {
+                "input": {"courseId": course_id, "itemId": item_id, "submissionId": None}
+            }
+        }
 
     def solve(self):
         """
@@ -64,15 +127,14 @@ class GradedSolver(object):
                 logger.error("No more attempts can be made!")
                 return
 
-            if not self.initiate_attempt():
+            if self.initiate_attempt() is None:
                 logger.error("Could not start an attempt. Please file an issue.")
                 return
 
             logger.info("New attempt started. Solving...")
-            time.sleep(2)
 
-            # Refetch state after starting the attempt
-            new_state = self.get_state()
+            # The mutation doesn't return the draft, so poll until the new attempt shows up
+            new_state = self._get_started_state()
             if new_state is None:
                 logger.error("Could not fetch state after starting a new attempt. Aborting.")
                 return
@@ -114,10 +176,7 @@ class GradedSolver(object):
             response_key, q_type_enum = QUESTION_TYPE_MAP[q_type]
             response_data = question.get(response_key)
 
-            is_answered = response_data and any(
-                response_data.get(key) for key in ["chosen", "answer", "plainText", "richText", "fileUrl"])
-
-            if is_answered:
+            if self._is_answered(question):
                 if response_data:
                     response_data.pop('__typename', None)
                 other_question_responses.append({
@@ -126,19 +185,7 @@ class GradedSolver(object):
                 })
             elif q_type in WHITELISTED_QUESTION_TYPES:
                 found_unanswered = True
-                prompt_html = question["questionSchema"]["prompt"].get("cmlValue", "")
-                soup = BeautifulSoup(prompt_html, 'html.parser')
-                prompt_text = soup.get_text(separator=' ', strip=True)
-
-                if q_type in ["Submission_CheckboxQuestion", "Submission_MultipleChoiceQuestion"]:
-                    options = [{"option_id": opt["optionId"],
-                                "value": BeautifulSoup(opt["display"]["cmlValue"], 'html.parser').get_text(
-                                    separator=' ', strip=True)} for opt in question["questionSchema"]["options"]]
-                    q_format_type = "Single-Choice" if q_type == "Submission_MultipleChoiceQuestion" else "Multi-Choice"
-                    questions_to_solve_formatted[part_id] = {"Question": prompt_text, "Options": options,
-                                                             "Type": q_format_type}
-                else:
-                    questions_to_solve_formatted[part_id] = {"Question": prompt_text, "Type": "Text-Entry"}
+                questions_to_solve_formatted[part_id] = self._format_question(question)
             else:  # Not whitelisted and not answered
                 other_question_responses.append({
                     "questionId": part_id, "questionType": q_type_enum,
@@ -156,14 +203,30 @@ class GradedSolver(object):
         logger.info(
             f"Found {len(questions_to_solve_formatted)} unanswered questions. Sending to LLM in a single batch.")
 
+        # Answers are saved in groups while the LLM is still generating the rest.
         connector = GeminiConnector()
-        answers = connector.get_response(questions_to_solve_formatted)
+        received_answers = []
+        unsaved_count = 0
+        try:
+            for answer in connector.stream_responses(questions_to_solve_formatted):
+                received_answers.append(answer)
+                unsaved_count += 1
+                if unsaved_count >= STREAMED_SAVE_BATCH_SIZE:
+                    if not self.save_responses(received_answers, other_question_responses):
+                        logger.error("Could not save the batch of responses. Aborting.")
+                        return
+                    unsaved_count = 0
+        except GeminiStreamError as e:
+            # Submitting now would spend a graded attempt with questions left unanswered
+            logger.error(f"{e}. Aborting without submitting.")
+            return
 
-        if not answers or "responses" not in answers or not answers["responses"]:
-            logger.error("Could not get a valid response from the LLM. Aborting.")
+        missing = set(questions_to_solve_formatted) - {answer.get("question_id") for answer in received_answers}
+        if missing:
+            logger.error(f"The LLM did not answer {len(missing)} of the questions. Aborting without submitting.")
             return
 
-        if not self.save_responses(answers["responses"], other_question_responses):
+        if unsaved_count and not self.save_responses(received_answers, other_question_responses):
             logger.error("Could not save the batch of responses. Aborting.")
             return
 
@@ -178,20 +241,14 @@ class GradedSolver(object):
 
     def _solve_sequentially(self, state: dict):
         """
-        Solves questions one by one in a loop, fetching state each time.
-        (Original solving method)
+        Solves questions in a loop, fetching state each time. Every unanswered
+        question of a pass is sent to the LLM in one batch, then the answers
+        are saved one at a time.
         """
-        # Pass initial state to avoid re-fetching on the first loop
-        initial_state = state
+        connector = GeminiConnector()
+        previously_unanswered = None
 
         while True:
-            # On subsequent loops, state will be None and we must refetch
-            if initial_state is None:
-                state = self.get_state()
-            else:
-                state = initial_state
-                initial_state = None  # Clear it after first use
-
             if not state or "inProgressAttempt" not in state.get("attempts", {}):
                 logger.error("Could not find an active attempt to continue. Aborting.")
                 return
@@ -202,8 +259,13 @@ class GradedSolver(object):
 
             questions = draft["draft"]["parts"]
 
-            question_to_solve_formatted = None
-            found_unanswered_whitelisted_question = False
+            # Cheap pre-scan, so that a fully answered draft goes straight to submission
+            if not any(q["__typename"] in WHITELISTED_QUESTION_TYPES and not self._is_answered(q)
+                       for q in questions):
+                logger.info("All solvable questions appear to be answered. Proceeding to submission.")
+                break
+
+            questions_to_solve_formatted = {}
             other_question_responses = []
 
             for question in questions:
@@ -217,10 +279,7 @@ class GradedSolver(object):
                 response_key, q_type_enum = QUESTION_TYPE_MAP[q_type]
                 response_data = question.get(response_key)
 
-                is_answered = response_data and any(
-                    response_data.get(key) for key in ["chosen", "answer", "plainText", "richText", "fileUrl"])
-
-                if is_answered:
+                if self._is_answered(question):
                     if response_data:
                         response_data.pop('__typename', None)
                     other_question_responses.append({
@@ -228,21 +287,8 @@ class GradedSolver(object):
                         "questionType": q_type_enum,
                         "questionResponse": {response_key: response_data}
                     })
-                elif not found_unanswered_whitelisted_question and q_type in WHITELISTED_QUESTION_TYPES:
-                    found_unanswered_whitelisted_question = True
-                    prompt_html = question["questionSchema"]["prompt"].get("cmlValue", "")
-                    soup = BeautifulSoup(prompt_html, 'html.parser')
-                    prompt_text = soup.get_text(separator=' ', strip=True)
-
-                    if q_type in ["Submission_CheckboxQuestion", "Submission_MultipleChoiceQuestion"]:
-                        options = [{"option_id": opt["optionId"],
-                                    "value": BeautifulSoup(opt["display"]["cmlValue"], 'html.parser').get_text(
-                                        separator=' ', strip=True)} for opt in question["questionSchema"]["options"]]
-                        q_format_type = "Single-Choice" if q_type == "Submission_MultipleChoiceQuestion" else "Multi-Choice"
-                        question_to_solve_formatted = {
-                            part_id: {"Question": prompt_text, "Options": options, "Type": q_format_type}}
-                    else:
-                        question_to_solve_formatted = {part_id: {"Question": prompt_text, "Type": "Text-Entry"}}
+                elif q_type in WHITELISTED_QUESTION_TYPES:
+                    questions_to_solve_formatted[part_id] = self._format_question(question)
                 else:
                     other_question_responses.append({
                         "questionId": part_id,
@@ -250,57 +296,123 @@ class GradedSolver(object):
                         "questionResponse": {response_key: deep_blank_model(MODEL_MAP[q_type])}
                     })
 
-            if not found_unanswered_whitelisted_question:
-                logger.info("All solvable questions appear to be answered. Proceeding to submission.")
-                break
+            # Stop if the last pass's saves didn't answer anything, rather than retrying forever
+            unanswered = set(questions_to_solve_formatted)
+            if unanswered == previously_unanswered:
+                logger.error(f"The same {len(unanswered)} questions are still unanswered after saving. Aborting.")
+                return
+            previously_unanswered = unanswered
 
-            connector = GeminiConnector()
-            answers = connector.get_response(question_to_solve_formatted)
+            logger.info(f"Found {len(questions_to_solve_formatted)} unanswered questions. "
+                        f"Sending to LLM in a single batch.")
+
+            answers = connector.get_response(questions_to_solve_formatted)
 
             if not answers or "responses" not in answers or not answers["responses"]:
                 logger.error("Could not get a valid response from the LLM. Aborting.")
                 return
 
-            if not self.save_responses(answers["responses"], other_question_responses):
-                logger.error("Could not save the response. Aborting.")
-                return
+            saved_answers = []
+            for answer in answers["responses"]:
+                saved_answers.append(answer)
+                if not self.save_responses(saved_answers, other_question_responses):
+                    logger.error("Could not save the response. Aborting.")
+                    return
+                logger.info(f"Answered and saved question ID: {answer['question_id']}")
 
-            logger.info(f"Answered and saved question ID: {list(question_to_solve_formatted.keys())[0]}")
+            # Give the server a moment to register the saves, then refetch for the next pass
             time.sleep(2)
+            state = self.get_state()
 
         if self.submit_draft():
             self.check_grade()
         else:
             logger.error("Could not submit the assignment. Please file an issue.")
 
+    @staticmethod
+    def _is_answered(question: dict) -> bool:
+        """Checks the one response field that the question's type fills in once answered."""
+        q_type = question["__typename"]
+        answer_key = ANSWER_KEY_MAP.get(q_type)
+        if answer_key is None:
+            return False
+        response_data = question.get(QUESTION_TYPE_MAP[q_type][0])
+        return bool(response_data and response_data.get(answer_key))
+
+    def _format_question(self, question: dict) -> dict:
+        """
+        Formats a question part into the shape sent to the LLM. A part's prompt
+        and options never change within an attempt, so the result is cached by partId.
+        """
+        part_id = question["partId"]
+        if part_id in self.prompt_cache:
+            return self.prompt_cache[part_id]
+
+        q_type = question["__typename"]
+        prompt_html = question["questionSchema"]["prompt"].get("cmlValue", "")
+        prompt_text = _cml_to_text(prompt_html)
+
+        if q_type in ["Submission_CheckboxQuestion", "Submission_MultipleChoiceQuestion"]:
+            options = [{"option_id": opt["optionId"], "value": _cml_to_text(opt["display"]["cmlValue"])}
+                       for opt in question["questionSchema"]["options"]]
+            q_format_type = "Single-Choice" if q_type == "Submission_MultipleChoiceQuestion" else "Multi-Choice"
+            formatted = {"Question": prompt_text, "Options": options, "Type": q_format_type}
+        else:
+            formatted = {"Question": prompt_text, "Type": "Text-Entry"}
+
+        self.prompt_cache[part_id] = formatted
+        return formatted
+
     def check_grade(self):
         """Polls for the final grade after submission."""
         logger.debug("Waiting for grading results...")
-        max_retries = 6
-        retry_delay = 5
-        for i in range(max_retries):
+        # Back off exponentially (with jitter) so fast gradings are picked up early.
+        # The last delay is followed by one final poll.
+        retry_delays = [1, 2, 4, 8, 16, 30]
+        max_polls = len(retry_delays) + 1
+        for i in range(max_polls):
             outcome = self.get_grade()
             if outcome:
                 if outcome.get('isPassed'):
                     logger.info("Successfully passed the assignment.")
                 else:
                     logger.error("Sorry! Could not pass the assignment, maybe use a better model.")
+                    # Don't let the cache hand out the same answers on the next attempt.
+                    GeminiConnector.forget(list(self.prompt_cache.values()))
                 return
-            logger.debug(f"Grading not ready, retrying in {retry_delay}s... ({i + 1}/{max_retries})")
-            time.sleep(retry_delay)
-        else:
-            logger.error("Timed out waiting for grading results.")
+            if i == len(retry_delays):
+                break
+            retry_delay = retry_delays[i]
+            logger.debug(f"Grading not ready, retrying in {retry_delay}s... ({i + 1}/{max_polls})")
+            time.sleep(retry_delay + random.uniform(0, 0.5))
+
+        logger.error("Timed out waiting for grading results.")
+
+    def _post_graphql(self, opname: str, body: dict) -> httpx.Response:
+        """Posts a GraphQL body, serialized with orjson rather than httpx's stdlib json."""
+        return self.session.post(url=GRAPHQL_URL, params={"opname": opname}, content=orjson.dumps(body),
+                                 headers={"Content-Type": "application/json"})
+
+    def _post_mutation(self, opname: str, body: dict) -> Optional[dict]:
+        """Posts a mutation and parses its response, or returns None if the body isn't JSON (e.g. a 5xx page)."""
+        res = self._post_graphql(opname, body)
+        try:
+            return orjson.loads(res.content)
+        except orjson.JSONDecodeError:
+            logger.error(f"{opname} returned a non-JSON response (HTTP {res.status_code}) for item {self.item_id}.")
+            return None
+
+    @staticmethod
+    def _mutation_typename(res: dict, operation: str) -> str:
+        """Returns the __typename of a mutation's result, e.g. 'Submission_SaveResponsesSuccess'."""
+        return ((res.get("data") or {}).get(operation) or {}).get("__typename")
 
     def get_state(self) -> dict:
         """
         Retrieves the current state of the assessment, with robust error handling.
         """
         try:
-            res = self.session.post(url=GRAPHQL_URL, params={"opname": "QueryState"}, json={
-                "operationName": "QueryState",
-                "variables": {"courseId": self.course_id, "itemId": self.item_id},
-                "query": GET_STATE_QUERY
-            }).json()
+            res = orjson.loads(self._post_graphql("QueryState", self._state_body).content)
 
             query_state = res.get("data", {}).get("SubmissionState", {}).get("queryState")
 
@@ -311,21 +423,38 @@ class GradedSolver(object):
 
             return query_state
 
-        except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
             logger.error(f"An error occurred while fetching assignment state for item {self.item_id}: {e}")
             return None
 
-    def initiate_attempt(self) -> bool:
-        res = self.session.post(url=GRAPHQL_URL, params={"opname": "Submission_StartAttempt"}, json={
-            "operationName": "Submission_StartAttempt",
-            "variables": {"courseId": self.course_id, "itemId": self.item_id},
-            "query": INITIATE_ATTEMPT_QUERY
-        })
-        return "Submission_StartAttemptSuccess" in res.text
+    def initiate_attempt(self) -> Optional[dict]:
+        """
+        Starts a new attempt. Returns the Submission_StartAttempt payload on success, None otherwise.
+        """
+        res = self._post_mutation("Submission_StartAttempt", self._initiate_body)
+        if res is None or self._mutation_typename(res, "Submission_StartAttempt") != "Submission_StartAttemptSuccess":
+            return None
+        return res["data"]["Submission_StartAttempt"]
+
+    def _get_started_state(self, max_retries: int = 5, retry_delay: float = 0.5) -> Optional[dict]:
+        """
+        Fetches the state right after starting an attempt, retrying briefly
+        until the new in-progress attempt is visible.
+        """
+        state = None
+        for i in range(max_retries):
+            state = self.get_state()
+            if state and state.get("attempts", {}).get("inProgressAttempt"):
+                return state
+            if i < max_retries - 1:
+                time.sleep(retry_delay)
+        return state
 
     def save_responses(self, new_answers: list, existing_responses: list) -> bool:
         """
         Saves a payload containing new answers and all other existing/blank responses.
+        A save replaces the whole draft, so callers saving incrementally must pass
+        every new answer received so far, not just the latest ones.
         """
         answer_payload = []
         for answer in new_answers:
@@ -362,42 +491,27 @@ class GradedSolver(object):
             logger.debug("No responses to save.")
             return True
 
-        res = self.session.post(url=GRAPHQL_URL, params={"opname": "Submission_SaveResponses"}, json={
-            "operationName": "Submission_SaveResponses",
-            "variables": {
-                "input": {
-                    "courseId": self.course_id,
-                    "itemId": self.item_id,
-                    "attemptId": self.draft_id,
-                    "questionResponses": final_responses
-                }
-            },
-            "query": SAVE_RESPONSES_QUERY
-        })
+        save_input = self._save_body["variables"]["input"]
+        save_input["attemptId"] = self.draft_id
+        save_input["questionResponses"] = final_responses
+        res = self._post_mutation("Submission_SaveResponses", self._save_body)
 
-        if "Submission_SaveResponsesSuccess" in res.text:
+        if res is not None and self._mutation_typename(res, "Submission_SaveResponses") == "Submission_SaveResponsesSuccess":
             return True
 
         logger.error(f"Failed to save responses. Payload: {final_responses}")
-        logger.error(f"Server response: {res.json()}")
+        logger.error(f"Server response: {res}")
         return False
 
     def submit_draft(self) -> bool:
-        res = self.session.post(url=GRAPHQL_URL, params={"opname": "Submission_SubmitLatestDraft"}, json={
-            "operationName": "Submission_SubmitLatestDraft",
-            "query": SUBMIT_DRAFT_QUERY,
-            "variables": {
-                "input": {"courseId": self.course_id, "itemId": self.item_id, "submissionId": self.attempt_id}
-            }
-        })
-        return "Submission_SubmitLatestDraftSuccess" in res.text
+        self._submit_body["variables"]["input"]["submissionId"] = self.attempt_id
+        res = self._post_mutation("Submission_SubmitLatestDraft", self._submit_body)
+        if res is None:
+            return False
+        return self._mutation_typename(res, "Submission_SubmitLatestDraft") == "Submission_SubmitLatestDraftSuccess"
 
     def get_grade(self) -> dict:
-        res = self.session.post(url=GRAPHQL_URL, params={"opname": "QueryState"}, json={
-            "operationName": "QueryState",
-            "query": GET_STATE_QUERY,
-            "variables": {"courseId": self.course_id, "itemId": self.item_id}
-        }).json()
+        res = orjson.loads(self._post_graphql("QueryState", self._state_body).content)
         outcome = res.get("data", {}).get("SubmissionState", {}).get("queryState", {}).get("outcome")
         if outcome:
             logger.debug(f"Achieved {outcome.get('earnedGrade')} grade. Passed? {outcome.get('isPassed')}")
@@ -34,6 +34,29 @@ QUESTION_TYPE_MAP = {
 }
 
 
+# The response field that is filled in once a question has been answered.
+# Types mapped to None are never treated as answered.
+ANSWER_KEY_MAP = {
+    "Submission_CheckboxQuestion": "chosen",
+    "Submission_CheckboxReflectQuestion": "chosen",
+    "Submission_CodeExpressionQuestion": "answer",
+    "Submission_FileUploadQuestion": "fileUrl",
+    "Submission_MathQuestion": "answer",
+    "Submission_MultipleChoiceQuestion": "chosen",
+    "Submission_MultipleChoiceReflectQuestion": "chosen",
+    "Submission_MultipleFillableBlanksQuestion": None,
+    "Submission_NumericQuestion": "answer",
+    "Submission_OffPlatformQuestion": None,
+    "Submission_PlainTextQuestion": "plainText",
+    "Submission_RegexQuestion": "answer",
+    "Submission_RichTextQuestion": "richText",
+    "Submission_TextExactMatchQuestion": "answer",
+    "Submission_TextReflectQuestion": "answer",
+    "Submission_UrlQuestion": None,
+    "Submission_WidgetQuestion": "answer",
+}
+
+
 class Submission_CodeInput(BaseModel):
     code: Optional[str] = None
 
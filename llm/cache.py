@@ -0,0 +1,74 @@
+# https://github.com/serv0id/skipera
+import hashlib
+import sqlite3
+import threading
+import orjson
+
+CACHE_PATH = "answers.db"
+
+
+class AnswerCache(object):
+    """
+    Persistent cache of LLM answers, keyed by a hash of the question's text and
+    options rather than its ID so that answers survive across attempts and runs.
+    Chosen options are stored by their text and mapped back to the current
+    option IDs on lookup.
+    """
+    def __init__(self, path: str = CACHE_PATH):
+        # Items are solved from several threads, so one connection is shared behind a lock.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, answer BLOB NOT NULL)")
+
+    @staticmethod
+    def _key(question: dict) -> str:
+        option_values = sorted(option["value"] for option in question.get("Options", []))
+        text = "\x00".join([question["Type"], question["Question"], *option_values])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, question_id: str, question: dict) -> dict:
+        """
+        Returns the cached answer for a question in the LLM's response format,
+        or None if there is none (or its options no longer match).
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT answer FROM answers WHERE key = ?", (self._key(question),)).fetchone()
+        if row is None:
+            return None
+
+        cached = orjson.loads(row[0])
+        if cached["type"] == "Text":
+            if not cached["answer"]:
+                return None
+            return {"question_id": question_id, "type": "Text", "option_id": None, "answer": cached["answer"]}
+
+        option_ids = {option["value"]: option["option_id"] for option in question.get("Options", [])}
+        if not cached["options"] or not all(value in option_ids for value in cached["options"]):
+            return None
+        return {"question_id": question_id, "type": cached["type"], "answer": None,
+                "option_id": [option_ids[value] for value in cached["options"]]}
+
+    def put(self, question: dict, answer: dict):
+        """
+        Stores an answer, unless it is unusable: a choice answer that picks no
+        existing option, or an empty text answer. Caching those would hand the
+        same useless answer back on every later pass.
+        """
+        option_values = {option["option_id"]: option["value"] for option in question.get("Options", [])}
+        cached = {
+            "type": answer["type"],
+            "answer": answer.get("answer"),
+            "options": [option_values[option_id] for option_id in answer.get("option_id") or []
+                        if option_id in option_values]
+        }
+        if not (cached["answer"] if cached["type"] == "Text" else cached["options"]):
+            return
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO answers (key, answer) VALUES (?, ?)",
+                              (self._key(question), orjson.dumps(cached)))
+
+    def forget(self, questions: list):
+        """Drops the cached answers for the given questions, e.g. after a failed attempt."""
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM answers WHERE key = ?", [(self._key(q),) for q in questions])
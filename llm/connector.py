@@ -1,11 +1,34 @@
 # https://github.com/serv0id/skipera
-import json
-import requests
+import threading
+import httpx
+import ijson
+import orjson
 from config import GEMINI_API_KEY
+from llm.cache import AnswerCache
 from pydantic import BaseModel
-from typing import List, Literal, Optional
+from typing import Iterator, List, Literal, Optional
 from loguru import logger
 
+# Shared across connectors so the TLS connection to Gemini is kept alive between calls.
+# Generation can take a while for large batches, hence no timeout.
+_SESSION = httpx.Client(timeout=None)
+
+# Opened on first use, so runs that never call the LLM don't create the cache file.
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def _get_cache() -> AnswerCache:
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = AnswerCache()
+        return _CACHE
+
+
+class GeminiStreamError(Exception):
+    """Raised when a streamed Gemini response fails or ends before its JSON is complete."""
+
 
 # FIX: Updated the response format to handle both multiple-choice (option_id) and
 # text-based (answer) responses from the LLM. The `type` field now includes 'Text'
@@ -22,92 +45,187 @@ class ResponseList(BaseModel):
 
 
 class GeminiConnector(object):
+    # FIX: The system prompt is now more detailed, instructing the AI on how to handle
+    # different question types and return the correct field (`option_id` or `answer`).
+    SYSTEM_PROMPT: str = (
+        "You are an expert university professor and a subject matter expert in this field. Your task is to solve a graded university-level assignment. Your answers must be precise and accurate, as a failing grade is not an option."
+        "\n\n**Instructions for your thought process (do not include this in the final JSON output):**"
+        "\n1.  **Analyze the Question:** Read each question carefully to fully understand what is being asked. Identify key concepts, constraints, and requirements."
+        "\n2.  **Chain of Thought:** For each question, reason through the problem step-by-step. "
+        "    - If it is multiple choice, evaluate each option against the question. Eliminate incorrect options and justify why the chosen option is the best fit."
+        "    - If it requires a text or numeric answer, formulate your response based on your expert knowledge and calculations. Double-check your answer for correctness."
+        "\n3.  **Final Answer Formulation:** After your internal reasoning process is complete, format your final answer into the required JSON structure."
+        "\n\n**Instructions for the final JSON output:**"
+        "\n- The user has provided a JSON object where each key is a unique `question_id`."
+        "\n- Your response must be a JSON object containing a single key `responses`, which is a list of answer objects."
+        "\n- Each answer object must contain:"
+        "\n  - `question_id`: The ID of the question you are answering."
+        "\n  - `type`: The type of question, which will be 'Single-Choice', 'Multi-Choice', or 'Text-Entry'."
+        "\n  - **`option_id` OR `answer`**: "
+        "\n    - For 'Single-Choice' or 'Multi-Choice', provide the correct `option_id`(s) in the `option_id` field. The `answer` field must be `null`."
+        "\n    - For 'Text-Entry' questions (like numeric, regex, or free-text), provide the calculated or formulated string in the `answer` field. The `option_id` field must be `null`."
+        "\n- Do not include any explanations, reasoning, or extra text in the final JSON output. It must strictly adhere to the schema."
+    )
+
+    # FIX: The response schema is updated to be more flexible, allowing either 'option_id'
+    # or 'answer' to be present in the response for each question.
+    RESPONSE_SCHEMA: dict = {
+        "type": "object",
+        "properties": {
+            "responses": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question_id": {"type": "string"},
+                        "option_id": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "nullable": True
+                        },
+                        "answer": {
+                            "type": "string",
+                            "nullable": True
+                        },
+                        "type": {
+                            "type": "string",
+                            "enum": ["Single", "Multi", "Text"]
+                        }
+                    },
+                    "required": ["question_id", "type"]
+                }
+            }
+        },
+        "required": ["responses"]
+    }
+
     def __init__(self):
         self.API_URL: str = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
+        self.STREAM_API_URL: str = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:streamGenerateContent"
         self.API_KEY: str = GEMINI_API_KEY
+        self.session: httpx.Client = _SESSION
 
     def get_response(self, questions: dict) -> dict:
         """
         Sends the questions to Gemini and asks for the answers
-        in a JSON format.
+        in a JSON format. Questions answered in an earlier run are
+        served from the answer cache instead.
         """
-        logger.debug("Making an API Request to Gemini..")
+        cached_answers, uncached_questions = self._split_cached(questions)
+        if not uncached_questions:
+            return {"responses": cached_answers}
 
-        # FIX: The system prompt is now more detailed, instructing the AI on how to handle
-        # different question types and return the correct field (`option_id` or `answer`).
-        system_prompt = (
-            "You are an expert university professor and a subject matter expert in this field. Your task is to solve a graded university-level assignment. Your answers must be precise and accurate, as a failing grade is not an option."
-            "\n\n**Instructions for your thought process (do not include this in the final JSON output):**"
-            "\n1.  **Analyze the Question:** Read each question carefully to fully understand what is being asked. Identify key concepts, constraints, and requirements."
-            "\n2.  **Chain of Thought:** For each question, reason through the problem step-by-step. "
-            "    - If it is multiple choice, evaluate each option against the question. Eliminate incorrect options and justify why the chosen option is the best fit."
-            "    - If it requires a text or numeric answer, formulate your response based on your expert knowledge and calculations. Double-check your answer for correctness."
-            "\n3.  **Final Answer Formulation:** After your internal reasoning process is complete, format your final answer into the required JSON structure."
-            "\n\n**Instructions for the final JSON output:**"
-            "\n- The user has provided a JSON object where each key is a unique `question_id`."
-            "\n- Your response must be a JSON object containing a single key `responses`, which is a list of answer objects."
-            "\n- Each answer object must contain:"
-            "\n  - `question_id`: The ID of the question you are answering."
-            "\n  - `type`: The type of question, which will be 'Single-Choice', 'Multi-Choice', or 'Text-Entry'."
-            "\n  - **`option_id` OR `answer`**: "
-            "\n    - For 'Single-Choice' or 'Multi-Choice', provide the correct `option_id`(s) in the `option_id` field. The `answer` field must be `null`."
-            "\n    - For 'Text-Entry' questions (like numeric, regex, or free-text), provide the calculated or formulated string in the `answer` field. The `option_id` field must be `null`."
-            "\n- Do not include any explanations, reasoning, or extra text in the final JSON output. It must strictly adhere to the schema."
-        )
-
-        # FIX: The response schema is updated to be more flexible, allowing either 'option_id'
-        # or 'answer' to be present in the response for each question.
-        response_schema = {
-            "type": "object",
-            "properties": {
-                "responses": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "question_id": {"type": "string"},
-                            "option_id": {
-                                "type": "array",
-                                "items": {"type": "string"},
-                                "nullable": True
-                            },
-                            "answer": {
-                                "type": "string",
-                                "nullable": True
-                            },
-                            "type": {
-                                "type": "string",
-                                "enum": ["Single", "Multi", "Text"]
-                            }
-                        },
-                        "required": ["question_id", "type"]
-                    }
-                }
-            },
-            "required": ["responses"]
-        }
+        logger.debug("Making an API Request to Gemini..")
 
-        response = requests.post(url=self.API_URL, headers={
+        res = self.session.post(url=self.API_URL, headers={
             "Content-Type": "application/json"
         }, params={
             "key": self.API_KEY
-        }, json={
+        }, content=orjson.dumps(self._build_request_body(uncached_questions)))
+        response = self._parse_response(orjson.loads(res.content))
+
+        if not response.get("responses"):
+            if cached_answers:
+                logger.warning(f"Gemini gave no answers; returning only the {len(cached_answers)} cached ones.")
+                return {"responses": cached_answers}
+            return response
+
+        for answer in response["responses"]:
+            if answer.get("question_id") in uncached_questions:
+                _get_cache().put(uncached_questions[answer["question_id"]], answer)
+
+        return {"responses": [*cached_answers, *response["responses"]]}
+
+    def stream_responses(self, questions: dict) -> Iterator[dict]:
+        """
+        Like get_response, but streams the answer from Gemini and yields each
+        answer object as soon as it has been fully generated, so the caller can
+        start saving before the whole batch is done. Raises GeminiStreamError if
+        the request fails or the stream breaks off, after the answers so far.
+        """
+        cached_answers, uncached_questions = self._split_cached(questions)
+        yield from cached_answers
+        if not uncached_questions:
+            return
+
+        logger.debug("Making a streaming API Request to Gemini..")
+
+        answers = ijson.sendable_list()
+        parser = ijson.items_coro(answers, "responses.item")
+
+        with self.session.stream("POST", url=self.STREAM_API_URL, headers={
+            "Content-Type": "application/json"
+        }, params={
+            "key": self.API_KEY,
+            "alt": "sse"
+        }, content=orjson.dumps(self._build_request_body(uncached_questions))) as res:
+            if res.status_code != 200:
+                res.read()
+                raise GeminiStreamError(f"Gemini API returned HTTP {res.status_code}: {res.text}")
+
+            try:
+                for line in res.iter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    chunk = orjson.loads(line[len("data:"):])
+                    candidates = chunk.get("candidates")
+                    if not candidates:
+                        block_reason = chunk.get("promptFeedback", {}).get("blockReason", "unknown reason")
+                        raise GeminiStreamError(f"Gemini returned no candidates ({block_reason})")
+                    for part in candidates[0].get("content", {}).get("parts", []):
+                        parser.send(part.get("text", "").encode())
+
+                    for answer in answers:
+                        if answer.get("question_id") in uncached_questions:
+                            _get_cache().put(uncached_questions[answer["question_id"]], answer)
+                        yield answer
+                    del answers[:]
+
+                parser.close()
+            except (ijson.JSONError, orjson.JSONDecodeError, KeyError, IndexError) as e:
+                raise GeminiStreamError(f"Gemini's streamed response was malformed or incomplete: {e}") from e
+
+    @staticmethod
+    def _split_cached(questions: dict) -> tuple:
+        """Splits questions into a list of cached answers and a dict of questions still to ask."""
+        cached_answers = []
+        uncached_questions = {}
+        for question_id, question in questions.items():
+            answer = _get_cache().get(question_id, question)
+            if answer is None:
+                uncached_questions[question_id] = question
+            else:
+                cached_answers.append(answer)
+
+        if cached_answers:
+            logger.debug(f"Reusing {len(cached_answers)} cached answers.")
+        return cached_answers, uncached_questions
+
+    @staticmethod
+    def forget(questions: list):
+        """Evicts cached answers, so that the questions are asked again next time."""
+        _get_cache().forget(questions)
+
+    def _build_request_body(self, questions: dict) -> dict:
+        return {
             "contents": [
                 {
                     "parts": [
-                        {"text": system_prompt},
-                        {"text": json.dumps(questions)}
+                        {"text": self.SYSTEM_PROMPT},
+                        {"text": orjson.dumps(questions).decode()}
                     ]
                 }
             ],
             "generationConfig": {
                 "response_mime_type": "application/json",
-                "response_schema": response_schema
+                "response_schema": self.RESPONSE_SCHEMA
             }
-        }).json()
+        }
 
+    @staticmethod
+    def _parse_response(response: dict) -> dict:
         if "error" in response:
             logger.error(f"Gemini API Error: {response['error']['message']}")
             return {}
 
-        return json.loads(response["candidates"][0]["content"]["parts"][0]["text"])
\ No newline at end of file
+        return orjson.loads(response["candidates"][0]["content"]["parts"][0]["text"])
\ No newline at end of file
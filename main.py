@@ -1,7 +1,11 @@
 # https://github.com/serv0id/skipera
 import click
-import requests
+import getpass
+import re
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import config
+from pathlib import Path
 from loguru import logger
 from assessment.solver import GradedSolver
 
@@ -11,9 +15,10 @@ class Skipera(object):
         self.user_id = None
         self.course_id = None
         self.base_url = config.BASE_URL
-        self.session = requests.Session()
-        self.session.headers.update(config.HEADERS)
-        self.session.cookies.update(config.COOKIES)
+        # HTTP/2 lets every GraphQL call multiplex over one kept-alive connection.
+        self.session = httpx.Client(http2=True, headers=config.HEADERS, cookies=config.COOKIES,
+                                    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+                                    timeout=30, follow_redirects=True)
         self.course = course
         self.llm = llm
         if not self.get_userid():
@@ -64,9 +69,14 @@ class Skipera(object):
             "fields": "onDemandCourseMaterialItems.v2(name,slug,timeCommitment,trackId)",
             "showLockedItems": "true"
         }).json()
-        for video in r["linked"]["onDemandCourseMaterialItems.v2"]:
-            logger.info("Processing " + video["name"])
-            self.watch_item(video["id"])
+        # Items are independent and network-bound, so several are processed at once.
+        # The httpx client is thread-safe and every item gets its own GradedSolver.
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(self.process_item, r["linked"]["onDemandCourseMaterialItems.v2"]))
+
+    def process_item(self, item):
+        logger.info("Processing " + item["name"])
+        self.watch_item(item["id"])
 
     def watch_item(self, item_id):
         r = self.session.post(
@@ -93,25 +103,19 @@ class Skipera(object):
                 logger.warning(f"Item {item_id} is a quiz/assignment, but the --llm flag is not set. Skipping.")
 
 
-import tkinter as tk
-from tkinter import simpledialog
-
 def prompt_for_api_key():
     """
     Prompts the user for the Gemini API key and saves it to the config file.
     """
-    root = tk.Tk()
-    root.withdraw()  # Hide the main window
-    api_key = simpledialog.askstring("API Key", "Please enter your Gemini API key:", show='*')
+    api_key = getpass.getpass("Enter your Gemini API key: ")
     if api_key:
-        with open("config.py", "r") as f:
-            lines = f.readlines()
-        with open("config.py", "w") as f:
-            for line in lines:
-                if line.startswith("GEMINI_API_KEY"):
-                    f.write(f'GEMINI_API_KEY = "{api_key}"\n')
-                else:
-                    f.write(line)
+        config_file = Path("config.py")
+        src = config_file.read_text()
+        key_line = f'GEMINI_API_KEY = {api_key!r}'
+        new, replaced = re.subn(r'^GEMINI_API_KEY\s*=.*$', lambda _: key_line, src, count=1, flags=re.M)
+        if not replaced:
+            new = src.rstrip("\n") + f"\n{key_line}\n"
+        config_file.write_text(new)
         config.GEMINI_API_KEY = api_key
     return api_key
 